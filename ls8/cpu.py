@@ -2,6 +2,12 @@
 
 import sys
 
+try:
+    # compiled dispatch loop, see cpu_core.pyx
+    import cpu_core
+except ImportError:
+    cpu_core = None
+
 ### Registers ###
 R0 = 0x00
 R1 = 0x01
@@ -11,7 +17,6 @@ R4 = 0x04
 R5 = 0x05
 R6 = 0x06
 R7 = 0x07
-PROGRAM_END = 0x04
 SP = 0x07
 
 
@@ -65,6 +70,36 @@ CMP_CLEAR = 0b11111000
 EQ = 0x01
 GT = 0x02
 LT = 0x04
+# CMP flag indexed by (a > b) << 1 | (a < b)
+CMP_RESULT = (EQ, LT, GT, 0)
+# CMP operand marking that no comparison has run yet
+CMP_UNSET = -1
+
+# Meanings of the bits in the first byte of each instruction: AABCDDDD
+#   AA Number of operands for this opcode, 0-2
+#   B 1 if this is an ALU operation
+#   C 1 if this instruction sets the PC
+#   DDDD Instruction identifier
+LEN_TABLE = bytes((op >> NUM_OPERANDS) + 1 for op in range(256))
+SETS_PC_TABLE = bytes((op >> OP_SETS_INST) & ONE_BIT for op in range(256))
+
+### Compiled Blocks ###
+# instructions a block can run, anything else stops the CPU
+BLOCK_OPS = {LDI, PRN, CMP, PUSH, POP, JMP, JEQ, JNE, HLT,
+             ADD, MUL, AND, OR, XOR, NOT, SHL, SHR}
+# returned by a block that ran HLT
+HALTED = -1
+# Python source for the ALU instructions, filled in with the operands
+BLOCK_ALU = {
+    ADD: "reg[{a}] = (reg[{a}] + reg[{b}]) & 0xff",
+    MUL: "reg[{a}] = (reg[{a}] * reg[{b}]) & 0xff",
+    AND: "reg[{a}] &= reg[{b}]",
+    OR: "reg[{a}] |= reg[{b}]",
+    XOR: "reg[{a}] ^= reg[{b}]",
+    NOT: "reg[{a}] = ~reg[{a}] & 0xff",
+    SHL: "reg[{a}] = (reg[{a}] << reg[{b}]) & 0xff",
+    SHR: "reg[{a}] >>= reg[{b}]",
+}
 
 ### Stack ###
 STACK_HEAD = 0xf4
@@ -74,6 +109,12 @@ DONE = 0
 UNKNOWN_INSTRUCTION = 1
 IO_ERROR = 2
 STACK_OVERFLOW = 3
+# not an exit code, marks a register operand outside R0-R7
+BAD_REGISTER = -1
+
+
+class StackOverflow(Exception):
+    """PUSH would grow the stack into the loaded program."""
 
 
 class CPU:
@@ -81,262 +122,212 @@ class CPU:
 
     def __init__(self):
         """Construct a new CPU."""
-        self.ram = [0] * 256
-        self.reg = [0] * 8
+        self.ram = bytearray(256)
+        self.reg = bytearray(8)
         self.reg[SP] = STACK_HEAD
         self.pc = 0x00
-        self.fl = 0x00
-
-        self.perform_op = {}
-        self.perform_op[LDI] = self._ldi
-        self.perform_op[PRN] = self._prn
-        self.perform_op[HLT] = self._hlt
-        self.perform_op[PUSH] = self._push
-        self.perform_op[POP] = self._pop
-        self.perform_op[JMP] = self._jmp
-        self.perform_op[JEQ] = self._jeq
-        self.perform_op[JNE] = self._jne
-        ### ALU Operations ###
-        self.perform_op[ADD] = self._add
-        self.perform_op[MUL] = self._mul
-        self.perform_op[CMP] = self._cmp
-        self.perform_op[AND] = self._and
-        self.perform_op[OR] = self._or
-        self.perform_op[XOR] = self._xor
-        self.perform_op[NOT] = self._not
-        self.perform_op[SHL] = self._shl
-        self.perform_op[SHR] = self._shr
+        # first address past the loaded program, the stack can't grow below it
+        self.program_end = 0x00
+        # CMP just records its operands, see fl
+        self._cmp_a = 0
+        self._cmp_b = CMP_UNSET
         self.is_running = False
-
-    def _ldi(self, *operands):
-        """LDI registerA
-
-        Set the value of a register to an integer."""
-
-        self.reg[operands[0]] = operands[1]
-
-    def _prn(self, *operands):
-        """PRN registerA
-
-        Print numeric value stored in the given register."""
-        print(self.reg[operands[0]])
-
-    def _hlt(self, *operands):
-        """HLT
-
-        Halt the CPU (and exit the emulator)."""
-
-        self.is_running = False
-
-    def _add(self, *operands):
-        """ADD registerA registerB
-
-        Add the value in two registers and store the result in registerA."""
-        self.alu("ADD", *operands)
-
-    def _mul(self, *operands):
-        """MUL registerA registerB
-
-        Multiply the values in two registers together and store the result in registerA."""
-        self.alu("MUL", *operands)
-
-    def _cmp(self, *operands):
-        """CMP registerA registerB
-
-        Compare the values in two registers.
-            • If they are equal, set the Equal E flag to 1, otherwise set it to 0.
-            • If registerA is less than registerB, set the Less-than L flag to 1, otherwise set it to 0.
-            • If registerA is greater than registerB, set the Greater-than G flag to 1, otherwise set it to 0."""
-        self.alu("CMP", *operands)
-
-    def _and(self, *operands):
-        """AND registerA registerB
-
-        Bitwise-AND the values in registerA and registerB, then store the result in registerA."""
-        self.alu("AND", *operands)
-
-    def _or(self, *operands):
-        """OR registerA registerB
-
-        Perform a bitwise-OR between the values in registerA and registerB, storing the result in registerA."""
-        self.alu("OR", *operands)
-
-    def _xor(self, *operands):
-        """XOR registerA registerB
-
-        Perform a bitwise-XOR between the values in registerA and registerB, storing the result in registerA."""
-        self.alu("XOR", *operands)
-
-    def _not(self, *operands):
-        """NOT register`
-
-        Perform a bitwise-NOT on the value in a register, storing the result in the register."""
-        self.alu("NOT", *operands)
-
-    def _shl(self, *operands):
-        """SHL registerA registerB
-
-        Shift the value in registerA left by the number of bits specified in registerB, filling the low bits with 0."""
-        self.alu("SHL", *operands)
-
-    def _shr(self, *operands):
-        """SHR registerA registerB
-
-        Shift the value in registerA right by the number of bits specified in registerB, filling the high bits with 0."""
-        self.alu("SHR", *operands)
-
-    def _pop(self, *operands):
-        """POP registerA
-
-        Pop the value at the top of the stack into the given register."""
-        self.reg[operands[0]] = self.ram_read(self.reg[SP])
-        if self.reg[SP] < STACK_HEAD:
-            self.reg[SP] += 1
-
-    def _push(self, *operands):
-        """PUSH registerA
-
-        Push the value in the given register on the stack."""
-        if (self.reg[SP]-1) >= self.reg[PROGRAM_END]:
-            self.reg[SP] -= 1
-            self.ram_write(self.reg[SP], self.reg[operands[0]])
-        else:
-            print(f"Stack Overflow!!")
-            self.trace()
-            self._shutdown(STACK_OVERFLOW)
-
-    def _jmp(self, *operands):
-        """JMP register
-
-        Jump to the address stored in the given register."""
-        self.pc = self.reg[operands[0]]
-
-    def _jeq(self, *operands):
-        """JEQ register
-
-        If equal flag is set (true), jump to the address stored in the given register."""
-        if self.fl & EQ:
-            self.pc = self.reg[operands[0]]
-        else:
-            self.pc += 2
-
-    def _jne(self, *operands):
-        """JNE register
-
-        If E flag is clear (false, 0), jump to the address stored in the given register."""
-        if not (self.fl & EQ):
-            self.pc = self.reg[operands[0]]
-        else:
-            self.pc += 2
+        # trace every instruction while running
+        self.debug = False
+        self._clear_blocks()
+
+    @property
+    def fl(self):
+        """Flags register, worked out from the operands of the last CMP."""
+        if self._cmp_b == CMP_UNSET:
+            return 0x00
+        a = self._cmp_a
+        b = self._cmp_b
+        return CMP_RESULT[(a > b) << 1 | (a < b)]
 
     def load(self, program_path):
         """Load a program into memory."""
-        address = 0
-
         try:
             with open(program_path) as program:
-                for line in program:
-                    split_line = line.split("#")
-                    instruction = split_line[0].strip()
-                    if instruction != "":
-                        self.ram[address] = int(instruction, 2)
-                        address += 1
-        except:
+                source = program.read()
+            # one instruction per line, anything after a "#" is a comment
+            instructions = (line.split("#", 1)[0].strip() for line in source.splitlines())
+            code = bytearray(int(inst, 2) & ONE_BYTE for inst in instructions if inst)
+        except (OSError, ValueError):
             print(f"Cannot open file at \"{program_path}\"")
             self._shutdown(IO_ERROR)
 
-        # store end of program into PROGRAM_END register
-        self.reg[PROGRAM_END] = address
+        if len(code) > len(self.ram):
+            print(f"Program at \"{program_path}\" does not fit in RAM")
+            self._shutdown(IO_ERROR)
+        self.ram[:len(code)] = code
+        self.program_end = len(code)
+        self._clear_blocks()
+
+    def _clear_blocks(self):
+        """Forget the compiled blocks, see _compile_block.
 
-    def _to_next_instruction(self, ir):
-        # Meanings of the bits in the first byte of each instruction: AABCDDDD
-        #   AA Number of operands for this opcode, 0-2
-        #   B 1 if this is an ALU operation
-        #   C 1 if this instruction sets the PC
-        #   DDDD Instruction identifier
-        isPcAlreadySet = ir >> OP_SETS_INST
-        isPcAlreadySet = isPcAlreadySet & ONE_BIT
-        if not isPcAlreadySet:
-            self.pc += (ir >> NUM_OPERANDS) + 1
+        Blocks are compiled lazily the first time the program reaches each
+        address, with separate copies that trace every instruction for
+        debug runs. Only blocks that lie within the loaded program are kept.
+        PUSH refuses to grow the stack into the program, so those stay valid
+        while it runs, but it can rewrite code past the end of the program."""
+        self.blocks = [None] * len(self.ram)
+        self.traced_blocks = [None] * len(self.ram)
 
     def _shutdown(self, exit_code=DONE):
         print("Shutting Down...")
         sys.exit(exit_code)
 
-    def alu(self, op, reg_a, reg_b):
-        """ALU operations."""
-
-        if op == "ADD":
-            self.reg[reg_a] += self.reg[reg_b]
-        # elif op == "SUB": etc
-        elif op == "MUL":
-            self.reg[reg_a] *= self.reg[reg_b]
-        elif op == "CMP":
-            # clear the CMP flag bits
-            self.fl &= CMP_CLEAR
-            if self.reg[reg_a] < self.reg[reg_b]:
-                self.fl |= LT
-            elif self.reg[reg_a] > self.reg[reg_b]:
-                self.fl |= GT
-            else:
-                self.fl |= EQ
-        elif op == "AND":
-            self.reg[reg_a] &= self.reg[reg_b]
-        elif op == "OR":
-            self.reg[reg_a] |= self.reg[reg_b]
-        elif op == "XOR":
-            self.reg[reg_a] ^= self.reg[reg_b]
-        elif op == "NOT":
-            self.reg[reg_a] = ~self.reg[reg_a]
-        elif op == "SHL":
-            self.reg[reg_a] = self.reg[reg_a] << self.reg[reg_b]
-        elif op == "SHR":
-            self.reg[reg_a] = self.reg[reg_a] >> self.reg[reg_b]
-        else:
-            raise Exception("Unsupported ALU operation")
-
-        # Clamp results to one byte
-        self.reg[reg_a] &= ONE_BYTE
-
     def trace(self):
         """
-        Handy function to print out the CPU state. You might want to call this
-        from run() if you need help debugging.
+        Handy function to print out the CPU state. Set debug to have run()
+        call this before every instruction.
         """
-        print(f"TRACE: %02X | %02X %02X %02X |" % (
-            self.pc,
-            # self.fl,
-            # self.ie,
-            self.ram_read(self.pc),
-            self.ram_read(self.pc + 1),
-            self.ram_read(self.pc + 2)
-        ), end='')
-
-        for i in range(8):
-            print(" %02X" % self.reg[i], end='')
-
-        print()
+        pc = self.pc
+        instruction = self.ram[pc:pc + 3].hex(" ").upper()
+        registers = self.reg.hex(" ").upper()
+        sys.stdout.write(f"TRACE: {pc:02X} | {instruction} | {registers}\n")
 
+    # ram_read/ram_write are for callers outside the CPU; the CPU itself
+    # indexes self.ram directly
     def ram_read(self, mar):
         return self.ram[mar]
 
     def ram_write(self, mar, mdr):
-        self.ram[mar] = mdr
+        self.ram[mar] = mdr & ONE_BYTE
 
     def run(self):
         """Run the CPU."""
         print("Running...")
         self.is_running = True
-        while self.is_running:
-            instruction_reg = self.ram_read(self.pc)
-            op_a = self.ram_read(self.pc + 1)
-            op_b = self.ram_read(self.pc + 2)
-            if instruction_reg in self.perform_op:
-                self.trace()
-                self.perform_op[instruction_reg](op_a, op_b)
-                self._to_next_instruction(instruction_reg)
+        try:
+            if cpu_core is not None and not self.debug:
+                self._run_compiled()
             else:
-                print(f"Unknown Instruction {instruction_reg}")
-                self._shutdown(UNKNOWN_INSTRUCTION)
-
+                self._run_blocks()
+        except StackOverflow:
+            print(f"Stack Overflow!!")
+            self.trace()
+            self._shutdown(STACK_OVERFLOW)
+        finally:
+            self.is_running = False
         self._shutdown()
+
+    def _run_compiled(self):
+        """Run the program on the compiled loop from cpu_core."""
+        self.pc, self._cmp_a, self._cmp_b, status = cpu_core.run(
+            self.ram, self.reg, self.pc, self.program_end, self._cmp_a, self._cmp_b)
+        if status == UNKNOWN_INSTRUCTION:
+            print(f"Unknown Instruction {self.ram[self.pc]}")
+            self._shutdown(UNKNOWN_INSTRUCTION)
+        elif status == STACK_OVERFLOW:
+            raise StackOverflow()
+        elif status == BAD_REGISTER:
+            # the same error the blocks get indexing the registers
+            raise IndexError("bytearray index out of range")
+
+    def _run_blocks(self):
+        """Run the program as compiled basic blocks, see _compile_block."""
+        traced = self.debug
+        blocks = self.traced_blocks if traced else self.blocks
+        ram = self.ram
+        reg = self.reg
+        pc = self.pc
+        while pc != HALTED:
+            block = blocks[pc]
+            if block is None:
+                block = self._compile_block(pc, traced)
+            pc = block(reg, ram)
+
+    def _compile_block(self, start, traced=False):
+        """Compile the basic block at start into a Python function.
+
+        The function takes the register file and RAM, runs the straight-line
+        instructions from start up to and including the first one that sets
+        the PC, halts or isn't recognised, with their operands filled in as
+        constants, and returns the address to continue from (or HALTED).
+        A register set by an LDI earlier in the block holds a known value,
+        so a jump through it returns a constant. With traced set, trace() is
+        called before each instruction. The block is cached if it lies within
+        the loaded program, see _clear_blocks."""
+        # padded so the operands of the last couple of addresses can be read
+        ram = self.ram + bytes(2)
+        lines = []
+        # registers holding a value known when the block was compiled
+        known = {}
+        # whether a CMP in this block has put its operands in locals
+        local_cmp = False
+        pc = start
+        while True:
+            op = ram[pc]
+            a = ram[pc + 1]
+            b = ram[pc + 2]
+            next_pc = pc + LEN_TABLE[op]
+
+            # an instruction the CPU can't run stops it without a trace
+            if traced and op in BLOCK_OPS:
+                lines.append(f"cpu.pc = {pc}")
+                lines.append(f"cpu.trace()")
+            if op == LDI:
+                lines.append(f"reg[{a}] = {b}")
+                known[a] = b
+            elif op in BLOCK_ALU:
+                lines.append(BLOCK_ALU[op].format(a=a, b=b))
+                known.pop(a, None)
+            elif op == PRN:
+                lines.append(f"print(reg[{a}])")
+            elif op == CMP:
+                lines.append(f"cpu._cmp_a = cmp_a = reg[{a}]")
+                lines.append(f"cpu._cmp_b = cmp_b = reg[{b}]")
+                local_cmp = True
+            elif op == PUSH:
+                lines.append(f"sp = reg[{SP}] - 1")
+                lines.append(f"if sp < {self.program_end}:")
+                lines.append(f"    cpu.pc = {pc}")
+                lines.append(f"    raise StackOverflow()")
+                lines.append(f"reg[{SP}] = sp")
+                lines.append(f"ram[sp] = reg[{a}]")
+                known.pop(SP, None)
+            elif op == POP:
+                lines.append(f"reg[{a}] = ram[reg[{SP}]]")
+                lines.append(f"if reg[{SP}] < {STACK_HEAD}:")
+                lines.append(f"    reg[{SP}] += 1")
+                known.pop(a, None)
+                known.pop(SP, None)
+            elif op in (JMP, JEQ, JNE):
+                target = known[a] if a in known else f"reg[{a}]"
+                if op == JMP:
+                    lines.append(f"return {target}")
+                else:
+                    test = "==" if op == JEQ else "!="
+                    if local_cmp:
+                        lines.append(f"if cmp_a {test} cmp_b:")
+                    else:
+                        lines.append(f"if cpu._cmp_a {test} cpu._cmp_b:")
+                    lines.append(f"    return {target}")
+                    lines.append(f"return {next_pc & ONE_BYTE}")
+            elif op == HLT:
+                lines.append(f"cpu.pc = {next_pc}")
+                lines.append(f"return HALTED")
+            else:
+                lines.append(f"cpu.pc = {pc}")
+                lines.append(f"print('Unknown Instruction {op}')")
+                lines.append(f"cpu._shutdown({UNKNOWN_INSTRUCTION})")
+
+            if op == HLT or op not in BLOCK_OPS or SETS_PC_TABLE[op]:
+                break
+            if next_pc >= len(self.ram):
+                # ran off the end of memory, wrap around like the compiled core
+                lines.append(f"return {next_pc & ONE_BYTE}")
+                break
+            pc = next_pc
+
+        source = "def block(reg, ram):\n" + "".join(f"    {line}\n" for line in lines)
+        namespace = {"cpu": self, "StackOverflow": StackOverflow, "HALTED": HALTED}
+        exec(compile(source, f"<block {start:02X}>", "exec"), namespace)
+        block = namespace["block"]
+        if next_pc <= self.program_end:
+            blocks = self.traced_blocks if traced else self.blocks
+            blocks[start] = block
+        return block
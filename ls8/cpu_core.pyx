@@ -0,0 +1,162 @@
+# cython: language_level=3
+"""Compiled dispatch loop for the LS-8 CPU.
+
+Build it next to cpu.py with:
+
+    cythonize -i cpu_core.pyx
+
+cpu.py picks it up automatically and falls back to running the program in
+Python when it hasn't been built. Debug runs always run in Python, since
+this loop doesn't trace.
+"""
+
+### Registers ###
+cdef enum:
+    SP = 0x07
+    NUM_REGISTERS = 8
+
+### OP-Codes ###
+cdef enum:
+    ADD = 0b10100000
+    MUL = 0b10100010
+    CMP = 0b10100111
+    AND = 0b10101000
+    NOT = 0b01101001
+    OR = 0b10101010
+    XOR = 0b10101011
+    SHL = 0b10101100
+    SHR = 0b10101101
+    JMP = 0b01010100
+    JEQ = 0b01010101
+    JNE = 0b01010110
+    HLT = 0b00000001
+    LDI = 0b10000010
+    PUSH = 0b01000101
+    POP = 0b01000110
+    PRN = 0b01000111
+
+### Bit Tools ###
+cdef enum:
+    ONE_BYTE = 0xff
+
+### Stack ###
+cdef enum:
+    STACK_HEAD = 0xf4
+
+### Exit Codes ###
+cdef enum:
+    DONE = 0
+    UNKNOWN_INSTRUCTION = 1
+    STACK_OVERFLOW = 3
+    # not an exit code, marks a register operand outside R0-R7
+    BAD_REGISTER = -1
+
+
+def run(bytearray memory, bytearray registers, int pc, int program_end, int cmp_a, int cmp_b):
+    """Run from pc until HLT or a fault.
+
+    memory and registers are updated in place, and the stack may not grow
+    below program_end. CMP only records its operands in cmp_a and cmp_b,
+    the jumps compare them when they run. Returns (pc, cmp_a, cmp_b,
+    status) where status is one of the exit codes and pc points past the
+    HLT or at the faulting instruction. Reading a register operand outside
+    R0-R7 stops with BAD_REGISTER instead."""
+    # padded so operands past the end of memory read as 0
+    cdef unsigned char ram[258]
+    cdef int reg[NUM_REGISTERS]
+    cdef int i, op, a, b
+    cdef int status = DONE
+
+    for i in range(258):
+        ram[i] = memory[i] if i < 256 else 0
+    for i in range(NUM_REGISTERS):
+        reg[i] = registers[i]
+
+    while True:
+        op = ram[pc]
+        a = ram[pc + 1]
+        b = ram[pc + 2]
+
+        # operands index the C register array, so check them where they're
+        # read, in the same order as the Python blocks
+        if a >= NUM_REGISTERS and op in (LDI, ADD, MUL, PRN, CMP, JMP, POP,
+                                         AND, OR, XOR, NOT, SHL, SHR):
+            status = BAD_REGISTER
+            break
+        if b >= NUM_REGISTERS and op in (ADD, MUL, AND, OR, XOR, SHL, SHR):
+            status = BAD_REGISTER
+            break
+
+        if op == LDI:
+            reg[a] = b
+        elif op == ADD:
+            reg[a] = (reg[a] + reg[b]) & ONE_BYTE
+        elif op == MUL:
+            reg[a] = (reg[a] * reg[b]) & ONE_BYTE
+        elif op == PRN:
+            print(reg[a])
+        elif op == CMP:
+            cmp_a = reg[a]
+            if b >= NUM_REGISTERS:
+                status = BAD_REGISTER
+                break
+            cmp_b = reg[b]
+        elif op == JEQ:
+            if cmp_a == cmp_b:
+                if a >= NUM_REGISTERS:
+                    status = BAD_REGISTER
+                    break
+                pc = reg[a]
+                continue
+        elif op == JNE:
+            if cmp_a != cmp_b:
+                if a >= NUM_REGISTERS:
+                    status = BAD_REGISTER
+                    break
+                pc = reg[a]
+                continue
+        elif op == JMP:
+            pc = reg[a]
+            continue
+        elif op == PUSH:
+            if reg[SP] - 1 < program_end:
+                status = STACK_OVERFLOW
+                break
+            reg[SP] -= 1
+            if a >= NUM_REGISTERS:
+                status = BAD_REGISTER
+                break
+            ram[reg[SP]] = reg[a]
+        elif op == POP:
+            reg[a] = ram[reg[SP]]
+            if reg[SP] < STACK_HEAD:
+                reg[SP] += 1
+        elif op == AND:
+            reg[a] &= reg[b]
+        elif op == OR:
+            reg[a] |= reg[b]
+        elif op == XOR:
+            reg[a] ^= reg[b]
+        elif op == NOT:
+            reg[a] = ~reg[a] & ONE_BYTE
+        # C shifts by the width of an int or more are undefined, and any
+        # count past 7 empties a byte anyway
+        elif op == SHL:
+            reg[a] = 0 if reg[b] > 7 else (reg[a] << reg[b]) & ONE_BYTE
+        elif op == SHR:
+            reg[a] = 0 if reg[b] > 7 else reg[a] >> reg[b]
+        elif op == HLT:
+            pc += 1
+            break
+        else:
+            status = UNKNOWN_INSTRUCTION
+            break
+
+        pc = (pc + (op >> 6) + 1) & ONE_BYTE
+
+    for i in range(256):
+        memory[i] = ram[i]
+    for i in range(NUM_REGISTERS):
+        registers[i] = reg[i]
+
+    return pc, cmp_a, cmp_b, status
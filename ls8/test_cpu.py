@@ -0,0 +1,410 @@
+"""Tests for the CPU.
+
+Run from the ls8 directory with:
+
+    python -m unittest test_cpu
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import cpu
+from cpu import (ADD, CMP, EQ, GT, HLT, JEQ, JMP, JNE, LDI, LT, POP, PRN, PUSH,
+                 SHL, SHR, SP, R0, R1, R2, R3, R4, R5, R6)
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# what each example prints between "Running..." and "Shutting Down...", and
+# the code it exits with
+EXPECTED = {
+    "call.ls8": (["Unknown Instruction 80"], 1),
+    "interrupts.ls8": (["Unknown Instruction 132"], 1),
+    "keyboard.ls8": (["Unknown Instruction 132"], 1),
+    "mult.ls8": (["72"], 0),
+    "print8.ls8": (["8"], 0),
+    "printstr.ls8": (["Unknown Instruction 80"], 1),
+    "sctest.ls8": (["1", "4", "5"], 0),
+    "stack.ls8": (["2", "4", "1"], 0),
+    "stackoverflow.ls8": ([str(n) for n in range(227)] + ["Stack Overflow!!"], 3),
+}
+
+# how many TRACE lines a debug run of each example prints, the same as the
+# original loop
+DEBUG_TRACES = {
+    "call.ls8": 2,
+    "interrupts.ls8": 2,
+    "keyboard.ls8": 2,
+    "mult.ls8": 5,
+    "print8.ls8": 3,
+    "printstr.ls8": 3,
+    "sctest.ls8": 24,
+    "stack.ls8": 14,
+    "stackoverflow.ls8": 911,
+}
+
+# run_program() options for each way of running a program
+ENGINES = {"blocks": {}, "traced blocks": {"debug": True}}
+if cpu.cpu_core is not None:
+    ENGINES["cpu_core"] = {"core": cpu.cpu_core}
+
+
+def run_program(path, debug=False, core=None):
+    """Run the program at path and return what it left behind.
+
+    Uses the compiled core when one is given, otherwise compiled blocks
+    (traced blocks with debug set). An IndexError from a register operand
+    past R7 is caught and returned as raised."""
+    machine = cpu.CPU()
+    machine.debug = debug
+    output = io.StringIO()
+    with mock.patch.object(cpu, "cpu_core", core), contextlib.redirect_stdout(output):
+        machine.load(path)
+        raised = None
+        with collect_exit_code() as exit_code:
+            try:
+                machine.run()
+            except IndexError as error:
+                raised = type(error)
+    lines = output.getvalue().splitlines()
+    return {
+        "output": [line for line in lines if not line.startswith("TRACE")],
+        "traces": sum(line.startswith("TRACE") for line in lines),
+        "exit_code": exit_code[0],
+        "pc": machine.pc,
+        "registers": bytes(machine.reg),
+        "ram": bytes(machine.ram),
+        "flags": machine.fl,
+        "raised": raised,
+        "running": machine.is_running,
+    }
+
+
+def run_code(code, **options):
+    """Run a program given as a list of bytes, see run_program."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "program.ls8")
+        with open(path, "w") as program:
+            program.writelines(f"{byte:08b}\n" for byte in code)
+        return run_program(path, **options)
+
+
+@contextlib.contextmanager
+def collect_exit_code():
+    """Collect the code run() exits with, instead of exiting."""
+    exit_code = [None]
+    try:
+        yield exit_code
+    except SystemExit as exit:
+        exit_code[0] = exit.code
+
+
+class ExampleTest(unittest.TestCase):
+
+    def test_every_example_is_expected(self):
+        self.assertEqual(sorted(EXPECTED), sorted(os.listdir(EXAMPLES)))
+
+    def test_examples(self):
+        for name, (printed, exit_code) in EXPECTED.items():
+            for engine, options in ENGINES.items():
+                with self.subTest(program=name, engine=engine):
+                    result = run_program(os.path.join(EXAMPLES, name), **options)
+                    self.assertEqual(result["output"], ["Running...", *printed, "Shutting Down..."])
+                    self.assertEqual(result["exit_code"], exit_code)
+
+    @unittest.skipIf(cpu.cpu_core is None, "cpu_core has not been built")
+    def test_compiled_core_matches_blocks(self):
+        for name in EXPECTED:
+            with self.subTest(program=name):
+                path = os.path.join(EXAMPLES, name)
+                self.assertEqual(run_program(path), run_program(path, core=cpu.cpu_core))
+
+    def test_stack_overflow_stops_at_the_push(self):
+        path = os.path.join(EXAMPLES, "stackoverflow.ls8")
+        for engine, options in ENGINES.items():
+            with self.subTest(engine=engine):
+                result = run_program(path, **options)
+                self.assertEqual(result["pc"], 0x0E)
+                if not options.get("debug"):
+                    # just the trace from the overflow report
+                    self.assertEqual(result["traces"], 1)
+
+    def test_stopped_after_running(self):
+        for name in EXPECTED:
+            for engine, options in ENGINES.items():
+                with self.subTest(program=name, engine=engine):
+                    self.assertFalse(run_program(os.path.join(EXAMPLES, name), **options)["running"])
+
+    def test_traced_blocks_match_blocks(self):
+        for name in EXPECTED:
+            with self.subTest(program=name):
+                path = os.path.join(EXAMPLES, name)
+                blocks = run_program(path)
+                traced = run_program(path, debug=True)
+                del blocks["traces"], traced["traces"]
+                self.assertEqual(blocks, traced)
+
+    def test_debug_traces_every_instruction(self):
+        for name, traces in DEBUG_TRACES.items():
+            with self.subTest(program=name):
+                result = run_program(os.path.join(EXAMPLES, name), debug=True)
+                self.assertEqual(result["traces"], traces)
+
+    def test_no_traces_without_debug(self):
+        self.assertEqual(run_program(os.path.join(EXAMPLES, "sctest.ls8"))["traces"], 0)
+
+
+class ProgramTest(unittest.TestCase):
+
+    def assertPrints(self, code, printed, exit_code=0):
+        """Check that every engine running code prints printed and exits
+        with exit_code."""
+        for engine, options in ENGINES.items():
+            with self.subTest(engine=engine):
+                result = run_code(code, **options)
+                self.assertEqual(result["output"], ["Running...", *printed, "Shutting Down..."])
+                self.assertEqual(result["exit_code"], exit_code)
+
+    def test_jump_into_the_middle_of_a_block(self):
+        # LDI R0 and PRN R0 at 0x08 compile into one block, the second pass
+        # jumps straight to the PRN
+        self.assertPrints([
+            LDI, R2, 0x0F,
+            LDI, R1, 0x08,
+            JMP, R1,
+            LDI, R0, 9,
+            PRN, R0,
+            JMP, R2,
+            LDI, R0, 4,
+            LDI, R2, 0x1A,
+            LDI, R1, 0x0B,
+            JMP, R1,
+            HLT,
+        ], ["9", "4"])
+
+    def test_jump_without_its_ldi(self):
+        # LDI R1 and JMP R1 at 0x00 compile to a jump to 0x08, the second
+        # pass jumps straight to the JMP with R1 pointing at 0x05 instead;
+        # going back to 0x08 would loop until the stack overflows
+        self.assertPrints([
+            LDI, R1, 0x08,
+            JMP, R1,
+            PRN, R1,
+            HLT,
+            PRN, R1,
+            PUSH, R1,
+            LDI, R1, 0x05,
+            LDI, R2, 0x03,
+            JMP, R2,
+        ], ["8", "5"])
+
+    def test_conditional_jump_away_from_its_compare(self):
+        # CMP R0,R1 finds them equal, then JMP R2 reaches the jump
+        for jump, printed in ((JEQ, ["15"]), (JNE, ["11", "15"])):
+            with self.subTest(jump=jump):
+                self.assertPrints([
+                    LDI, R2, 0x0B,
+                    LDI, R3, 0x0F,
+                    CMP, R0, R1,
+                    JMP, R2,
+                    jump, R3,
+                    PRN, R2,
+                    PRN, R3,
+                    HLT,
+                ], printed)
+
+    def test_code_pushed_onto_the_stack(self):
+        # pushes PRN R0; JMP R3 to 0xF0 and jumps there, then pops the
+        # operand, pushes R1 in its place and jumps there again
+        self.assertPrints([
+            LDI, R0, 10,
+            LDI, R1, 20,
+            LDI, R2, 0xF0,
+            LDI, R4, PRN,
+            LDI, R5, JMP,
+            LDI, R6, R3,
+            PUSH, R6,
+            PUSH, R5,
+            LDI, R6, R0,
+            PUSH, R6,
+            PUSH, R4,
+            LDI, R3, 0x22,
+            JMP, R2,
+            POP, R6,
+            POP, R6,
+            LDI, R6, R1,
+            PUSH, R6,
+            PUSH, R4,
+            LDI, R3, 0x32,
+            JMP, R2,
+            HLT,
+        ], ["10", "20"])
+
+    def test_run_past_the_end_of_memory(self):
+        # the first pass jumps to the end of memory, which carries on from 0
+        # and halts on the second pass
+        ends = (
+            (0xFD, [ADD, R3, R0], ["1", "3"]),
+            # a conditional jump that isn't taken falls through to 0 as well
+            (0xFE, [JNE, R1], ["1", "2"]),
+        )
+        for address, end, printed in ends:
+            start = [
+                LDI, R0, 1,
+                ADD, R3, R0,
+                PRN, R3,
+                CMP, R3, R0,
+                LDI, R1, address,
+                JEQ, R1,
+                HLT,
+            ]
+            padding = [0] * (address - len(start))
+            with self.subTest(end=end):
+                self.assertPrints(start + padding + end, printed)
+
+    def test_flags_follow_the_last_compare(self):
+        compares = (([], 0), ([CMP, R0, R1], LT), ([CMP, R1, R0], GT), ([CMP, R0, R0], EQ))
+        for compare, flags in compares:
+            for engine, options in ENGINES.items():
+                with self.subTest(compare=compare, engine=engine):
+                    result = run_code([LDI, R0, 1, LDI, R1, 2, *compare, HLT], **options)
+                    self.assertEqual(result["flags"], flags)
+
+    def test_shift_by_more_than_seven(self):
+        self.assertPrints([
+            LDI, R0, 1,
+            LDI, R1, 32,
+            SHL, R0, R1,
+            PRN, R0,
+            LDI, R0, 200,
+            LDI, R1, 33,
+            SHR, R0, R1,
+            PRN, R0,
+            HLT,
+        ], ["0", "0"])
+
+    def test_programs_can_use_r4(self):
+        # R4 used to hold the end of the program, so this PUSH overflowed
+        self.assertPrints([
+            LDI, R4, 0xFF,
+            PUSH, R4,
+            POP, R0,
+            PRN, R0,
+            HLT,
+        ], ["255"])
+
+    def test_register_operands_past_r7_that_are_never_read(self):
+        # the jump isn't taken, so R9 isn't read
+        self.assertPrints([
+            LDI, R1, 1,
+            CMP, R0, R1,
+            JEQ, 9,
+            PRN, R0,
+        ], ["0", "Unknown Instruction 0"], 1)
+        # the stack is full before PUSH reads R9
+        self.assertPrints([LDI, SP, 3, PUSH, 9, HLT], ["Stack Overflow!!"], 3)
+
+    def test_reading_a_register_past_r7(self):
+        programs = (
+            # the second CMP records R0 before it reads R9
+            ([LDI, R0, 1, LDI, R1, 2, CMP, R1, R0, CMP, R0, 9, HLT], EQ),
+            ([LDI, R0, 1, CMP, R0, R0, PUSH, 9, HLT], EQ),
+            ([PUSH, 9, HLT], 0),
+        )
+        for code, flags in programs:
+            results = {}
+            for engine, options in ENGINES.items():
+                with self.subTest(code=code, engine=engine):
+                    result = run_code(code, **options)
+                    self.assertIs(result["raised"], IndexError)
+                    self.assertEqual(result["output"], ["Running..."])
+                    self.assertEqual(result["flags"], flags)
+                    # the blocks only keep pc up to date when tracing
+                    del result["pc"], result["traces"]
+                    results[engine] = result
+            for engine, result in results.items():
+                with self.subTest(code=code, engine=engine):
+                    self.assertEqual(result, results["blocks"])
+
+    def test_load_skips_comments_and_blank_lines(self):
+        source = (
+            "# prints 8\n"
+            "\n"
+            "10000010 # LDI R0,8\n"
+            "00000000\n"
+            "00001000\n"
+            "  01000111\n"
+            "00000000\n"
+            "00000001\n"
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "program.ls8")
+            with open(path, "w") as program:
+                program.write(source)
+            result = run_program(path)
+        self.assertEqual(result["output"], ["Running...", "8", "Shutting Down..."])
+        self.assertEqual(result["ram"][:6], bytes([LDI, R0, 8, PRN, R0, HLT]))
+
+
+class LoadTest(unittest.TestCase):
+
+    def load(self, source):
+        """Load source into a new CPU, returning what it printed and the
+        code it exited with."""
+        machine = cpu.CPU()
+        output = io.StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "program.ls8")
+            with open(path, "w") as program:
+                program.write(source)
+            with contextlib.redirect_stdout(output), collect_exit_code() as exit_code:
+                machine.load(path)
+        return output.getvalue().splitlines(), exit_code[0]
+
+    def test_program_that_fills_ram(self):
+        self.assertEqual(self.load("00000001\n" * 256), ([], None))
+
+    def test_program_too_big_for_ram(self):
+        output, exit_code = self.load("00000001\n" * 257)
+        self.assertEqual(len(output), 2)
+        self.assertTrue(output[0].endswith("does not fit in RAM"))
+        self.assertEqual(exit_code, cpu.IO_ERROR)
+
+    def test_unreadable_program(self):
+        output, exit_code = self.load("00000001\nHLT\n")
+        self.assertTrue(output[0].startswith("Cannot open file"))
+        self.assertEqual(exit_code, cpu.IO_ERROR)
+
+    def test_missing_program(self):
+        machine = cpu.CPU()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), collect_exit_code() as exit_code:
+            machine.load(os.path.join(EXAMPLES, "missing.ls8"))
+        self.assertTrue(output.getvalue().startswith("Cannot open file"))
+        self.assertEqual(exit_code[0], cpu.IO_ERROR)
+
+
+class TraceTest(unittest.TestCase):
+
+    def trace(self, pc):
+        machine = cpu.CPU()
+        machine.ram[:3] = bytes([LDI, R0, 8])
+        machine.reg[R1] = 0xAB
+        machine.pc = pc
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            machine.trace()
+        return output.getvalue()
+
+    def test_trace(self):
+        self.assertEqual(self.trace(0x00), "TRACE: 00 | 82 00 08 | 00 AB 00 00 00 00 00 F4\n")
+
+    def test_trace_at_the_end_of_memory(self):
+        self.assertEqual(self.trace(0xFE), "TRACE: FE | 00 00 | 00 AB 00 00 00 00 00 F4\n")
+
+
+if __name__ == "__main__":
+    unittest.main()